@@ -0,0 +1,7 @@
+import os
+
+# scripts/app.py refuses to import without a key; tests never reach the API
+os.environ.setdefault("COHERE_API_KEY", "test-key")
+
+# Manual smoke script that calls the live API at import time
+collect_ignore = ["scripts/test_cohere_chat.py"]
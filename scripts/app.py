@@ -1,13 +1,24 @@
 # scripts/app.py
 
 import os
+import asyncio
 import logging
+import logging.handlers
+import queue
+import threading
 import re
-import wikipedia
+import time
+import hashlib
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+import numpy as np
+import cachetools
+import httpx
 import cohere
 
 from fastapi import FastAPI, HTTPException
-from fastapi.responses import HTMLResponse, FileResponse
+from fastapi.responses import FileResponse
+from fastapi.staticfiles import StaticFiles
 from pydantic import BaseModel, Field
 from duckduckgo_search import DDGS
 from duckduckgo_search.duckduckgo_search import DuckDuckGoSearchException
@@ -17,23 +28,48 @@ COHERE_KEY = os.getenv("COHERE_API_KEY")
 if not COHERE_KEY:
     raise RuntimeError("Set COHERE_API_KEY as an environment variable")
 
-co = cohere.Client(COHERE_KEY)
+co = cohere.AsyncClient(COHERE_KEY)
 MODEL = "command-xlarge-nightly"
 WEB_RESULTS = 3
 LOG_FILE = "research.log"
+WIKI_API = "https://en.wikipedia.org/w/api.php"
+STATIC_DIR = os.path.join(os.path.dirname(__file__), "static")
+
+# Upper bounds (seconds) on each upstream call
+SEARCH_TIMEOUT = 5.0
+EMBED_TIMEOUT = 5.0
+COHERE_TIMEOUT = 30.0
+
+# Exact cache: identical questions within the TTL skip all upstream calls
+EXACT_CACHE_TTL = 3600
+EXACT_CACHE_SIZE = 10_000
+
+# Semantic cache: reuse lessons for near-duplicate questions
+SEMANTIC_CACHE = os.getenv("SEMANTIC_CACHE", "1") == "1"
+EMBED_MODEL = "embed-english-light-v3.0"
+SIMILARITY_THRESHOLD = 0.93
+MAX_CACHE = 512
 
 # ─── LOGGER ─────────────────────────────────────────────────────────────
+# Handlers only enqueue records; a listener thread does the file writes
 logger = logging.getLogger("research")
 logger.setLevel(logging.INFO)
 fh = logging.FileHandler(LOG_FILE, encoding="utf-8")
 fh.setFormatter(logging.Formatter("%(asctime)s %(message)s"))
-logger.addHandler(fh)
+log_queue = queue.SimpleQueue()
+logger.addHandler(logging.handlers.QueueHandler(log_queue))
+log_listener = logging.handlers.QueueListener(log_queue, fh)
 
 # ─── REQUEST SCHEMA ─────────────────────────────────────────────────────
 class ResearchRequest(BaseModel):
     text: str = Field(..., description="Your how-to question here")
 
+class ResearchResponse(BaseModel):
+    result: str = Field(..., description="The step-by-step lesson")
+
 # ─── HELPERS ────────────────────────────────────────────────────────────
+_HEADING_RE = re.compile(r'^\s*(\*{2}.*\*{2}|#{1,6})')
+
 def strip_md_heading(text: str) -> str:
     """
     Remove any leading Markdown heading lines:
@@ -41,110 +77,303 @@ def strip_md_heading(text: str) -> str:
      • ATX headings (# through ######)
     """
     lines = text.splitlines()
-    pattern = re.compile(r'^\s*(\*{2}.*\*{2}|#{1,6})')
-    while lines and pattern.match(lines[0]):
+    while lines and _HEADING_RE.match(lines[0]):
         lines.pop(0)
     return "\n".join(lines).strip()
 
+def consume_result(task: asyncio.Task):
+    # Mark a discarded task's outcome as retrieved so asyncio doesn't warn
+    task.cancelled() or task.exception()
+
 # ─── SEARCH UTILITIES ──────────────────────────────────────────────────
+# DDGS mutates its client headers and rate-limit timestamp on every call,
+# so instances aren't shared between threads. Each to_thread worker keeps
+# its own, reusing that instance's connection pool across questions.
+# The client timeout matches SEARCH_TIMEOUT so a worker abandoned by
+# wait_for isn't held much longer than the request waited.
+_ddgs_local = threading.local()
+
+def get_ddgs() -> DDGS:
+    ddgs = getattr(_ddgs_local, "ddgs", None)
+    if ddgs is None:
+        ddgs = _ddgs_local.ddgs = DDGS(timeout=int(SEARCH_TIMEOUT))
+    return ddgs
+
 def ddg_search(query: str):
     results = []
     try:
-        with DDGS() as ddgs:
-            for r in ddgs.text(query, max_results=WEB_RESULTS):
-                body = r.get("body", "").strip()
-                if body:
-                    results.append(body)
+        for r in get_ddgs().text(query, max_results=WEB_RESULTS):
+            body = r.get("body", "").strip()
+            if body:
+                results.append(body)
     except DuckDuckGoSearchException as e:
         logger.warning(f"DuckDuckGo failed: {e}")
     return results
 
-def wiki_search(query: str):
+async def wiki_search(query: str):
+    # Search and intro extracts in one MediaWiki request
     results = []
     try:
-        for title in wikipedia.search(query, results=WEB_RESULTS):
-            summary = wikipedia.summary(title, sentences=2)
-            results.append(summary)
+        resp = await app.state.http.get(WIKI_API, params={
+            "action": "query",
+            "format": "json",
+            "generator": "search",
+            "gsrsearch": query,
+            "gsrlimit": WEB_RESULTS,
+            "prop": "extracts",
+            "exintro": 1,
+            "explaintext": 1,
+            "exsentences": 2,
+        })
+        resp.raise_for_status()
+        pages = resp.json().get("query", {}).get("pages", {}).values()
+        # pages come back keyed by page id; "index" is the search rank
+        for page in sorted(pages, key=lambda p: p.get("index", 0)):
+            extract = page.get("extract", "").strip()
+            if extract:
+                results.append(extract)
     except Exception as e:
         logger.warning(f"Wikipedia failed: {e}")
     return results
 
+# ─── EXACT CACHE ───────────────────────────────────────────────────────
+# normalized question → lesson; bounded, entries expire after the TTL
+EXACT_CACHE = cachetools.TTLCache(maxsize=EXACT_CACHE_SIZE, ttl=EXACT_CACHE_TTL)
+
+# ─── SEMANTIC CACHE ────────────────────────────────────────────────────
+# normalized question → (unit-length embedding, lesson, expires_at),
+# least recently used first; entries share the exact cache's TTL
+_semantic_cache: "OrderedDict[str, tuple[np.ndarray, str, float]]" = OrderedDict()
+
+async def embed_question(question: str) -> np.ndarray:
+    resp = await co.embed(
+        texts=[question],
+        model=EMBED_MODEL,
+        input_type="search_query"
+    )
+    vec = np.asarray(resp.embeddings[0], dtype=np.float32)
+    return vec / np.linalg.norm(vec)
+
+def semantic_lookup(vec: np.ndarray):
+    """
+    Return the cached lesson most similar to `vec`, or None if no
+    entry reaches SIMILARITY_THRESHOLD. Vectors are stored normalized,
+    so one matrix-vector product gives every cosine similarity.
+    Expired entries are evicted first.
+    """
+    now = time.monotonic()
+    for key in [k for k, entry in _semantic_cache.items() if entry[2] <= now]:
+        del _semantic_cache[key]
+    if not _semantic_cache:
+        return None
+    keys = list(_semantic_cache)
+    matrix = np.stack([_semantic_cache[k][0] for k in keys])
+    scores = matrix @ vec
+    best = int(np.argmax(scores))
+    if scores[best] < SIMILARITY_THRESHOLD:
+        return None
+    _semantic_cache.move_to_end(keys[best])
+    return _semantic_cache[keys[best]][1]
+
+def semantic_store(key: str, vec: np.ndarray, lesson: str):
+    _semantic_cache[key] = (vec, lesson, time.monotonic() + EXACT_CACHE_TTL)
+    _semantic_cache.move_to_end(key)
+    while len(_semantic_cache) > MAX_CACHE:
+        _semantic_cache.popitem(last=False)
+
 # ─── COHERE CHAT CALL ──────────────────────────────────────────────────
-def call_cohere(prompt: str) -> str:
-    resp = co.chat(
+# The installed SDK returns one response shape, so the text accessor is
+# chosen from the first response and reused without further probing
+_extract_text = None
+
+def text_from_generations(resp):
+    # generations can come back empty; fall through as the SDK allows
+    if resp.generations:
+        return resp.generations[0].text
+    if hasattr(resp, "message"):
+        return resp.message
+    if hasattr(resp, "text"):
+        return resp.text
+    raise HTTPException(500, f"Unexpected response: {resp}")
+
+def pick_text_extractor(resp):
+    if hasattr(resp, "generations"):
+        return text_from_generations
+    if hasattr(resp, "message"):
+        return lambda r: r.message
+    if hasattr(resp, "text"):
+        return lambda r: r.text
+    return None
+
+async def cohere_chat(prompt: str) -> str:
+    global _extract_text
+    resp = await co.chat(
         model=MODEL,
         message=prompt,
         max_tokens=1024,
         temperature=0.5
     )
-    if hasattr(resp, "generations") and resp.generations:
-        text = resp.generations[0].text
-    elif hasattr(resp, "message"):
-        text = resp.message
-    elif hasattr(resp, "text"):
-        text = resp.text
-    else:
-        raise HTTPException(500, f"Unexpected response: {resp}")
-    return text.strip()
+    if _extract_text is None:
+        _extract_text = pick_text_extractor(resp)
+        if _extract_text is None:
+            raise HTTPException(500, f"Unexpected response: {resp}")
+    return _extract_text(resp).strip()
 
-# ─── PROMPT ASSEMBLY ───────────────────────────────────────────────────
-def research_steps(question: str) -> str:
-    snippets = ddg_search(question) or wiki_search(question)
+async def call_cohere(prompt: str) -> str:
+    # The timeout cancels the chat call itself, so a hung upstream
+    # doesn't keep its task and connection alive
+    return await asyncio.wait_for(cohere_chat(prompt), COHERE_TIMEOUT)
 
-    prompt = ""
+# ─── PROMPT ASSEMBLY ───────────────────────────────────────────────────
+def build_prompt(question: str, snippets) -> str:
+    # Collect the pieces and join once rather than growing a string
+    parts = []
     if snippets:
-        prompt += "Reference snippets:\n" + "\n".join(
-            f"{i+1}. {s}" for i, s in enumerate(snippets)
-        ) + "\n\n"
-
-    prompt += (
+        parts.append("Reference snippets:\n")
+        parts.extend(f"{i+1}. {s}\n" for i, s in enumerate(snippets))
+        parts.append("\n")
+    parts.append(
         f"You are a seasoned teacher explaining step by step how to {question}.\n"
         "Do not include any headings or labels like 'Introduction:' or 'Lesson:'.\n"
         "Start directly with a numbered list of steps, using simple examples or analogies.\n"
         "Keep it concise and clear.\n\n"
         "Steps:\n"
     )
+    return "".join(parts)
+
+# Full prompts and lessons are only written at DEBUG; INFO gets a
+# one-line summary keyed by a short digest
+def text_digest(text: str) -> str:
+    return hashlib.blake2b(text.encode("utf-8"), digest_size=8).hexdigest()
+
+def log_prompt(question: str, snippets, prompt: str):
+    digest = text_digest(prompt)
+    logger.info(f"q={question!r} snippets={len(snippets)} prompt={digest}")
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug(f"PROMPT {digest}:\n{prompt}\n{'-'*40}")
+
+def log_lesson(lesson: str):
+    digest = text_digest(lesson)
+    logger.info(f"lesson chars={len(lesson)} lesson={digest}")
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug(f"OUTPUT CLEANED {digest}:\n{lesson}\n{'='*60}")
+
+async def gather_snippets(question: str):
+    # Run both searches at once; prefer DuckDuckGo, fall back to Wikipedia
+    ddg_res, wiki_res = await asyncio.gather(
+        asyncio.wait_for(asyncio.to_thread(ddg_search, question), SEARCH_TIMEOUT),
+        asyncio.wait_for(wiki_search(question), SEARCH_TIMEOUT),
+        return_exceptions=True,
+    )
+    if isinstance(ddg_res, BaseException):
+        logger.warning(f"DuckDuckGo failed: {ddg_res!r}")
+        ddg_res = []
+    if isinstance(wiki_res, BaseException):
+        logger.warning(f"Wikipedia failed: {wiki_res!r}")
+        wiki_res = []
+    return ddg_res or wiki_res
 
-    logger.info(f"PROMPT:\n{prompt}\n{'-'*40}")
-    raw = call_cohere(prompt)
+async def research_steps(question: str) -> str:
+    cache_key = question.strip().lower()
+    cached = EXACT_CACHE.get(cache_key)
+    if cached is not None:
+        logger.info(f"EXACT CACHE HIT: {question}")
+        return cached
+
+    # Hedge: start an ungrounded generation alongside the searches. If the
+    # searches return snippets before it finishes it is cancelled in favour
+    # of a grounded call; otherwise its answer is used as-is. The semantic
+    # cache embedding runs alongside both and cancels them on a hit.
+    bare_prompt = build_prompt(question, None)
+    searches = asyncio.create_task(gather_snippets(question))
+    hedge = asyncio.create_task(call_cohere(bare_prompt))
+    hedge.add_done_callback(consume_result)
+    try:
+        q_vec = None
+        if SEMANTIC_CACHE:
+            try:
+                q_vec = await asyncio.wait_for(embed_question(cache_key), EMBED_TIMEOUT)
+            except Exception as e:
+                logger.warning(f"Embedding failed: {e!r}")
+            else:
+                cached = semantic_lookup(q_vec)
+                if cached is not None:
+                    logger.info(f"SEMANTIC CACHE HIT: {question}")
+                    return cached
+
+        await asyncio.wait({searches, hedge}, return_when=asyncio.FIRST_COMPLETED)
+        if not searches.done() and hedge.exception() is not None:
+            # The hedge failed outright; grounding is the only way forward
+            await searches
+        # False when the hedge answered while searches were still running
+        searched = searches.done()
+        snippets = searches.result() if searched else []
+
+        if snippets:
+            hedge.cancel()
+            prompt = build_prompt(question, snippets)
+            log_prompt(question, snippets, prompt)
+            raw = await call_cohere(prompt)
+        else:
+            if not searched:
+                logger.info("Searches still running, using the hedged answer")
+            log_prompt(question, snippets, bare_prompt)
+            raw = await hedge
+    except asyncio.TimeoutError:
+        logger.warning(f"Cohere timed out after {COHERE_TIMEOUT}s")
+        raise HTTPException(504, "Lesson generation timed out")
+    finally:
+        searches.cancel()
+        hedge.cancel()
     lesson = strip_md_heading(raw)
-    logger.info(f"OUTPUT CLEANED:\n{lesson}\n{'='*60}")
+    log_lesson(lesson)
+    # A hedged answer that beat the searches is a latency fallback; don't
+    # let one slow search pin it for every repeat of the question
+    if lesson and searched:
+        EXACT_CACHE[cache_key] = lesson
+        if q_vec is not None:
+            semantic_store(cache_key, q_vec, lesson)
     return lesson or "(no text returned)"
 
+# ─── STATIC FILES ──────────────────────────────────────────────────────
+class CachedStaticFiles(StaticFiles):
+    """
+    StaticFiles already answers If-None-Match with 304 via its ETag;
+    this adds a Cache-Control header so browsers and proxies can skip
+    the round-trip entirely on revisits.
+    """
+    def file_response(self, *args, **kwargs):
+        resp = super().file_response(*args, **kwargs)
+        resp.headers["Cache-Control"] = "public, max-age=86400"
+        return resp
+
 # ─── FASTAPI SETUP ─────────────────────────────────────────────────────
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # The log listener starts first and stops last so records logged
+    # during the rest of startup and teardown are still written
+    log_listener.start()
+    app.state.http = httpx.AsyncClient(
+        headers={"User-Agent": "how-to-teacher/1.0"}
+    )
+    try:
+        yield
+    finally:
+        await app.state.http.aclose()
+        log_listener.stop()
+
 app = FastAPI(
     title="How-To Teacher",
-    description="DuckDuckGo → Wikipedia → Cohere chat-based how-to lessons"
+    description="DuckDuckGo → Wikipedia → Cohere chat-based how-to lessons",
+    lifespan=lifespan
 )
 
-@app.get("/", response_class=HTMLResponse, include_in_schema=False)
-async def home():
-    return HTMLResponse("""
-<!doctype html><html><head><meta charset="utf-8"><title>How-To Teacher</title>
-<style>body{font-family:sans-serif;margin:2rem;}textarea{width:100%;margin-bottom:.5rem;}#text{height:8rem;}#out{width:100%;height:12rem;}button{padding:.5rem;margin-right:.5rem;}</style>
-</head><body><h1>How-To Teacher</h1>
-<textarea id="text" placeholder="Ask ‘how to…’ here"></textarea>
-<div><button onclick="run()">Run</button><button onclick="copy()">Copy</button></div>
-<textarea id="out" placeholder="Your lesson..." readonly></textarea>
-<script>
-async function run(){
-  const text = document.getElementById('text').value;
-  const res = await fetch('/process', {
-    method:'POST', headers:{'Content-Type':'application/json'},
-    body: JSON.stringify({text})
-  });
-  const data = await res.json();
-  document.getElementById('out').value = res.ok ? data.result : `Error ${res.status}\\n${data.detail||data}`;
-}
-function copy(){navigator.clipboard.writeText(document.getElementById('out').value); alert('Copied!');}
-</script></body></html>
-""")
-
-@app.post("/process")
-def process(req: ResearchRequest):
+# A declared response model lets FastAPI serialize straight to JSON bytes
+@app.post("/process", response_model=ResearchResponse)
+async def process(req: ResearchRequest):
     if not req.text.strip():
         raise HTTPException(400, "Empty question")
-    return {"result": research_steps(req.text.strip())}
+    return {"result": await research_steps(req.text.strip())}
 
 @app.get("/logs", summary="Download logs")
 def download_logs():
@@ -152,8 +381,12 @@ def download_logs():
         raise HTTPException(404, "No logs")
     return FileResponse(LOG_FILE, media_type="text/plain", filename=LOG_FILE)
 
-@app.get("/logs/raw", response_class=HTMLResponse)
+@app.get("/logs/raw", response_class=FileResponse)
 def view_logs():
     if not os.path.isfile(LOG_FILE):
         raise HTTPException(404, "No logs")
-    return HTMLResponse(open(LOG_FILE, encoding="utf-8").read())
+    # Streamed from disk in chunks and shown inline (no filename → no download)
+    return FileResponse(LOG_FILE, media_type="text/plain; charset=utf-8")
+
+# Registered last so the API routes above take precedence over the mount
+app.mount("/", CachedStaticFiles(directory=STATIC_DIR, html=True), name="static")
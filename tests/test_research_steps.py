@@ -0,0 +1,135 @@
+import asyncio
+from types import SimpleNamespace
+
+import numpy as np
+import pytest
+from fastapi import HTTPException
+from fastapi.testclient import TestClient
+
+from scripts import app
+
+
+class FakeCohere:
+    """Stands in for cohere.AsyncClient; grounded prompts start with snippets."""
+    def __init__(self, bare_delay=0.2, grounded_delay=0.05, bare_error=None):
+        self.delays = {"bare": bare_delay, "grounded": grounded_delay}
+        self.bare_error = bare_error
+        self.calls = []
+        self.cancelled = []
+
+    async def chat(self, model, message, **kwargs):
+        kind = "grounded" if message.startswith("Reference snippets") else "bare"
+        self.calls.append(kind)
+        try:
+            await asyncio.sleep(self.delays[kind])
+        except asyncio.CancelledError:
+            self.cancelled.append(kind)
+            raise
+        if kind == "bare" and self.bare_error:
+            raise self.bare_error
+        return SimpleNamespace(text=f"1. {kind} step")
+
+
+@pytest.fixture
+def fake_co(monkeypatch):
+    def install(**kwargs):
+        co = FakeCohere(**kwargs)
+        monkeypatch.setattr(app, "co", co)
+        return co
+    monkeypatch.setattr(app, "SEMANTIC_CACHE", False)
+    monkeypatch.setattr(app, "_extract_text", None)
+    app.EXACT_CACHE.clear()
+    yield install
+    app.EXACT_CACHE.clear()
+
+
+def fake_searches(monkeypatch, snippets, delay):
+    async def wiki_search(query):
+        await asyncio.sleep(delay)
+        return snippets
+    monkeypatch.setattr(app, "ddg_search", lambda query: [])
+    monkeypatch.setattr(app, "wiki_search", wiki_search)
+
+
+async def run(question):
+    lesson = await app.research_steps(question)
+    await asyncio.sleep(0.01)  # let cancellations land
+    return lesson
+
+
+def test_fast_snippets_cancel_hedge_and_ground(fake_co, monkeypatch):
+    co = fake_co(bare_delay=0.5)
+    fake_searches(monkeypatch, ["a snippet"], delay=0.01)
+    assert asyncio.run(run("bake bread")) == "1. grounded step"
+    assert co.cancelled == ["bare"]
+    assert app.EXACT_CACHE["bake bread"] == "1. grounded step"
+
+
+def test_hedge_beats_slow_searches_and_is_not_cached(fake_co, monkeypatch):
+    co = fake_co(bare_delay=0.05)
+    fake_searches(monkeypatch, ["a snippet"], delay=0.5)
+    assert asyncio.run(run("bake bread")) == "1. bare step"
+    assert co.calls == ["bare"]
+    assert "bake bread" not in app.EXACT_CACHE
+
+
+def test_empty_searches_use_and_cache_hedge(fake_co, monkeypatch):
+    co = fake_co(bare_delay=0.1)
+    fake_searches(monkeypatch, [], delay=0.01)
+    assert asyncio.run(run("bake bread")) == "1. bare step"
+    assert co.calls == ["bare"]
+    assert app.EXACT_CACHE["bake bread"] == "1. bare step"
+
+
+def test_failed_hedge_falls_back_to_grounded(fake_co, monkeypatch):
+    co = fake_co(bare_delay=0.01, bare_error=RuntimeError("boom"))
+    fake_searches(monkeypatch, ["a snippet"], delay=0.1)
+    assert asyncio.run(run("bake bread")) == "1. grounded step"
+    assert co.calls == ["bare", "grounded"]
+
+
+def test_failed_hedge_without_snippets_raises(fake_co, monkeypatch):
+    fake_co(bare_delay=0.01, bare_error=RuntimeError("boom"))
+    fake_searches(monkeypatch, [], delay=0.1)
+    with pytest.raises(RuntimeError):
+        asyncio.run(run("bake bread"))
+
+
+def test_cohere_timeout_returns_504(fake_co, monkeypatch):
+    co = fake_co(bare_delay=1.0, grounded_delay=1.0)
+    fake_searches(monkeypatch, ["a snippet"], delay=0.01)
+    monkeypatch.setattr(app, "COHERE_TIMEOUT", 0.05)
+    with pytest.raises(HTTPException) as exc:
+        asyncio.run(run("bake bread"))
+    assert exc.value.status_code == 504
+    assert co.cancelled == ["bare", "grounded"]
+
+
+def test_process_maps_timeout_to_504(fake_co, monkeypatch):
+    fake_co(bare_delay=1.0, grounded_delay=1.0)
+    fake_searches(monkeypatch, ["a snippet"], delay=0.01)
+    monkeypatch.setattr(app, "COHERE_TIMEOUT", 0.05)
+    with TestClient(app.app) as client:
+        resp = client.post("/process", json={"text": "bake bread"})
+    assert resp.status_code == 504
+
+
+def test_process_returns_lesson(fake_co, monkeypatch):
+    fake_co(bare_delay=0.5)
+    fake_searches(monkeypatch, ["a snippet"], delay=0.01)
+    with TestClient(app.app) as client:
+        resp = client.post("/process", json={"text": "bake bread"})
+    assert resp.status_code == 200
+    assert resp.json() == {"result": "1. grounded step"}
+
+
+def test_semantic_entries_expire_with_exact_cache_ttl(monkeypatch):
+    vec = np.ones(4, dtype=np.float32) / 2
+    monkeypatch.setattr(app, "_semantic_cache", app.OrderedDict())
+    clock = [1000.0]
+    monkeypatch.setattr(app.time, "monotonic", lambda: clock[0])
+    app.semantic_store("bake bread", vec, "1. knead")
+    assert app.semantic_lookup(vec) == "1. knead"
+    clock[0] += app.EXACT_CACHE_TTL
+    assert app.semantic_lookup(vec) is None
+    assert not app._semantic_cache